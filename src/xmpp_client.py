@@ -3,39 +3,169 @@
 XMPP Client Class - handles connection, authentication, and message handling
 """
 import xmpp
+import atexit
+import functools
+import heapq
+import itertools
+import logging
+import logging.handlers
 import os
 import threading
 import queue
+import re
+import selectors
+import socket
+import orjson
 import requests
 import time
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Log lines are queued and written out by a dedicated writer thread
+LOG_QUEUE_SIZE = 10000  # producers block once this many lines are pending
+LOG_BATCH_SIZE = 200  # max lines written per drain
+LOG_FILE_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+LOG_FD_CACHE_SIZE = 64  # max log files the writer keeps open
+
+# Max UI entries held for get_messages; the oldest are dropped if nobody drains them
+MESSAGE_QUEUE_SIZE = 10000
+
+# Seconds a subscriber may go without draining before it is dropped (closed browser tabs)
+SUBSCRIBER_TIMEOUT = 600
+
+# Number of recent incoming stanzas remembered for duplicate detection
+RECENT_STANZA_LIMIT = 1024
+# Seconds a stanza counts as a redelivery; peers restarting their id counters can
+# legitimately send the same (id, body) again later
+RECENT_STANZA_TTL = 60
+
+# API requests: (connect, read) timeouts in seconds
+API_TIMEOUT = (5, 10)
+# Seconds disconnect() waits for queued webhook posts before dropping the rest
+API_FLUSH_TIMEOUT = 5
+
+# Seconds a sender's roster metadata is reused before looking it up again
+METADATA_TTL = 60
+
+# Seconds get_roster reuses its last result
+ROSTER_CACHE_TTL = 5
+
+# Ticket polling backs off from POLL_MIN_INTERVAL to POLL_MAX_INTERVAL seconds while quiet
+POLL_MIN_INTERVAL = 1
+POLL_MAX_INTERVAL = 30
+
+# Markdown link: [text](url)
+_MD_LINK_RE = re.compile(r'\[([^\]]+)\]\(([^\)]+)\)')
+
+
+def _md_link_to_text(match):
+    """Replacement for _MD_LINK_RE: the URL, or "text: url" if the text differs"""
+    link_text, link_url = match.groups()
+    # Auto-linkified URLs (text == URL) are the common case: just return the URL
+    return link_url if link_text == link_url else link_text + ': ' + link_url
+
+
+def _utc_iso(when=None):
+    """ISO 8601 UTC timestamp with a 'Z' suffix for API payloads (default: now)"""
+    when = datetime.now(timezone.utc) if when is None else when.astimezone(timezone.utc)
+    return when.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+@functools.lru_cache(maxsize=1024)
+def _jid_to_folder(jid):
+    """Log folder name for a JID: user@server/resource -> user_at_server"""
+    node, _, domain = jid.partition('/')[0].partition('@')
+    return f"{node}_at_{domain}" if domain else node
+
+
 class XMPPClient:
     def __init__(self, log_dir='.purple/logs'):
         self.connection = None
         self.jid = None
+        self._bare_jid = None  # self.jid without the resource
+        self._current_username = None  # Node part of self.jid, names the user's log folder
+        self._jid_log_dir = None  # log_dir/<username>, holds one folder per conversation partner
         self.stop_event = threading.Event()
         self.process_thread = None
-        self.message_queue = queue.Queue()
+        self._wake_r = self._wake_w = None  # socketpair used by disconnect() to wake _process_loop
+        self.message_queue = deque(maxlen=MESSAGE_QUEUE_SIZE)  # Appended by the process thread, drained by get_messages
+        self._message_event = threading.Event()  # Set when message_queue gets an entry
+        # Consumers with their own queue (one per UI session); while there are any, entries go
+        # to each of them instead of message_queue. Replaced, never mutated, so the process
+        # thread can iterate it safely
+        self._subscribers = {}  # {subscriber id: {'queue': deque, 'event': Event, 'drained_at': monotonic time}}
+        self._subscriber_ids = itertools.count(1)
+        self._subscribers_lock = threading.Lock()  # Serializes add/remove_subscriber
         self.log_dir = log_dir
         os.makedirs(self.log_dir, exist_ok=True)
 
         # API configuration
         self.api_base_url = os.getenv('API_BASE_URL', '')
         self.api_token = os.getenv('API_TOKEN', '')
+        self._api_enabled = bool(self.api_base_url and self.api_token)
+        self._api_root = f"{self.api_base_url}/api/v1"
+        self._url_xmpp = f"{self._api_root}/webhooks/xmpp"
+        self._url_incoming = f"{self._url_xmpp}/incoming"
+        self._url_tickets = f"{self._url_xmpp}/tickets"
+
+        # Persistent HTTP session so API calls reuse pooled keep-alive connections
+        self.session = requests.Session()
+        # Retry transient gateway errors; urllib3 only retries idempotent methods,
+        # so webhook POSTs are never sent twice
+        retries = Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.api_token}',
+            'Content-Type': 'application/json'
+        })
+
+        # Worker threads for webhook calls (created on connect)
+        self._api_pool = None
+        self._api_pending = set()  # Webhook posts not finished yet, flushed on disconnect
+        self._api_pending_lock = threading.Lock()
 
         # Track active tickets per user
+        # Ticket dicts are never mutated in place: writers publish a new dict, so
+        # readers on other threads always see a consistent ticket
         self.user_tickets = {}  # {jid: {'ticket_id': str, 'last_message_count': int}}
-        self.polling_threads = {}  # {jid: thread}
+        self._ticket_polls = {}  # {jid: {'due', 'interval', 'errors', 'running', 'woken'}}
+        self._poll_heap = []  # [(due monotonic time, jid)], guarded by _poll_cv
+        self._poll_cv = threading.Condition()
+        self._poll_pool = None
+        self._poller_thread = None
 
         # Track current log file counter per person/date
         self.log_counters = {}  # {person_folder: {date: counter}}
+        self._ensured_dirs = set()  # Log directories already created
 
         # Track contacts from presence/messages (fallback for roster issues)
         self.discovered_contacts = set()  # Set of JIDs we've seen
+        self._roster_cache = (0.0, None)  # (monotonic time, contacts) from the last get_roster
+
+        # Sender metadata from the roster, reused for METADATA_TTL seconds
+        self._metadata_cache = {}  # {bare_jid: (monotonic time, metadata)}
+
+        # Recently handled incoming stanzas, oldest first (duplicate detection)
+        self._recent_stanzas = OrderedDict()  # {(sender, stanza_id, body_hash): monotonic time seen}
+
+        # Pending (filepath, UTF-8 line) tuples, written out by _log_writer_loop
+        self._log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._log_thread = None
+
+        # Open log file descriptor per conversation, reused across writes
+        self._log_fds = OrderedDict()  # {person_dir: (filepath, fd)}, least recently written first
+        self._log_fds_date = None  # Date prefix of the files in _log_fds
+        self._log_write_lock = threading.Lock()
 
     def connect(self, jabberid=None, password=None, resource=None):
         """Connect to XMPP server"""
@@ -70,6 +200,13 @@ class XMPPClient:
         if not auth:
             raise ConnectionError("Authentication failed")
 
+        # Log folder for this account (just username, not full JID)
+        self._bare_jid = jabberid.split('/')[0]
+        self._current_username = self._bare_jid.split('@')[0]
+        self._jid_log_dir = os.path.join(self.log_dir, self._current_username)
+        os.makedirs(self._jid_log_dir, exist_ok=True)
+        self._ensured_dirs.add(self._jid_log_dir)
+
         # Register handlers
         self.connection.RegisterHandler('message', self._message_handler)
         self.connection.RegisterHandler('presence', self._presence_handler)
@@ -79,19 +216,62 @@ class XMPPClient:
 
         # Start background processing thread
         self.stop_event.clear()
+        self._wake_r, self._wake_w = socket.socketpair()
         self.process_thread = threading.Thread(target=self._process_loop, daemon=True)
         self.process_thread.start()
 
+        # Start webhook workers so HTTP calls don't block the processing thread
+        self._api_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='api-webhook')
+
+        # Start the ticket scheduler (one thread for all monitored conversations)
+        if self._api_enabled:
+            self._poll_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ticket-poll')
+            self._poller_thread = threading.Thread(target=self._ticket_poll_loop, daemon=True)
+            self._poller_thread.start()
+            # Resume monitoring tickets from before a reconnect
+            for user_jid in list(self.user_tickets):
+                self._wake_ticket_monitor(user_jid)
+
+        # Start background log writer thread
+        self._log_thread = threading.Thread(target=self._log_writer_loop, daemon=True)
+        self._log_thread.start()
+        # The writer is a daemon thread; don't lose queued lines if the process exits while connected
+        atexit.register(self._flush_logs)
+
         return True
 
     def disconnect(self):
         """Disconnect from XMPP server"""
         if self.connection:
             self.stop_event.set()
+            if self._wake_w:
+                self._wake_w.send(b'\0')  # Wake _process_loop out of select()
             if self.process_thread:
                 self.process_thread.join(timeout=1)
+            if self._wake_w:
+                self._wake_r.close()
+                self._wake_w.close()
+                self._wake_r = self._wake_w = None
+            if self._api_pool:
+                self._flush_api_posts()
+            self.session.close()  # Release pooled keep-alive connections
+            with self._poll_cv:
+                # Cancelled polls would stay marked running; connect() starts monitoring afresh
+                self._ticket_polls.clear()
+                self._poll_heap.clear()
+                self._poll_cv.notify_all()  # Let the ticket scheduler see stop_event
+            if self._poll_pool:
+                self._poll_pool.shutdown(wait=False, cancel_futures=True)
+            if self._log_thread:
+                self._log_queue.put(None)  # Sentinel: writer drains, closes its files and exits
+                self._log_thread.join(timeout=5)
+                if not self._log_thread.is_alive():
+                    # Write anything logged after the sentinel
+                    self._flush_logs()
+                atexit.unregister(self._flush_logs)
             self.connection.disconnect()
             self.connection = None
+            self._roster_cache = (0.0, None)
 
     def send_message(self, to_jid, body, from_ai=False):
         """Send a message
@@ -112,7 +292,7 @@ class XMPPClient:
 
         # Log sent message with appropriate sender label
         msg_type = 'ai_sent' if from_ai else 'sent'
-        self._log_message(self.jid, to_jid, body, msg_type)
+        self._log_message(to_jid, body, msg_type)
 
     def set_status(self, status='available', status_message=''):
         """Set XMPP presence status
@@ -139,7 +319,7 @@ class XMPPClient:
             if status_message:
                 pres.setStatus(status_message)
             self.connection.send(pres)
-            print(f"Status set to: Invisible")
+            logger.info("Status set to: Invisible")
         else:
             # Send normal presence with show element
             pres = xmpp.Presence()
@@ -152,7 +332,7 @@ class XMPPClient:
                 pres.setStatus(status_message)
 
             self.connection.send(pres)
-            print(f"Status set to: {status.title()}" + (f" - {status_message}" if status_message else ""))
+            logger.info("Status set to: %s%s", status.title(), f" - {status_message}" if status_message else "")
 
         return True
 
@@ -168,15 +348,11 @@ class XMPPClient:
         Returns:
             dict with 'data' (list of tickets) and 'count' (int)
         """
-        if not self.api_base_url or not self.api_token:
+        if not self._api_enabled:
             return {'data': [], 'count': 0}
 
         try:
-            url = f"{self.api_base_url}/api/v1/webhooks/xmpp/tickets"
-            headers = {
-                'Authorization': f'Bearer {self.api_token}',
-                'Content-Type': 'application/json'
-            }
+            url = self._url_tickets
 
             params = {'skip': skip, 'limit': limit}
             if status:
@@ -184,17 +360,16 @@ class XMPPClient:
             if channel_source:
                 params['channel_source'] = channel_source
 
-            response = requests.get(url, headers=headers, params=params, timeout=10)
+            response = self.session.get(url, params=params, timeout=API_TIMEOUT)
 
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             else:
-                print(f"⚠️  Failed to fetch tickets: {response.status_code}")
-                print(f"   Response: {response.text}")
+                logger.warning("⚠️  Failed to fetch tickets: %s - %s", response.status_code, response.text)
                 return {'data': [], 'count': 0}
 
         except Exception as e:
-            print(f"⚠️  Error fetching tickets: {e}")
+            logger.warning("⚠️  Error fetching tickets: %s", e)
             return {'data': [], 'count': 0}
 
     def fetch_ticket_updates(self):
@@ -203,7 +378,7 @@ class XMPPClient:
         Uses the existing webhook endpoint that works with API keys:
         GET /api/v1/webhooks/xmpp/tickets/{ticket_id}/messages
         """
-        if not self.api_base_url or not self.api_token:
+        if not self._api_enabled:
             return []
 
         tickets = []
@@ -214,16 +389,12 @@ class XMPPClient:
 
             # Fetch messages for this ticket using the webhook endpoint
             try:
-                url = f"{self.api_base_url}/api/v1/webhooks/xmpp/tickets/{ticket_id}/messages"
-                headers = {
-                    'Authorization': f'Bearer {self.api_token}',
-                    'Content-Type': 'application/json'
-                }
+                url = f"{self._url_tickets}/{ticket_id}/messages"
 
-                response = requests.get(url, headers=headers, params={'limit': 5}, timeout=10)
+                response = self.session.get(url, params={'limit': 5}, timeout=API_TIMEOUT)
 
                 if response.status_code == 200:
-                    messages = response.json()
+                    messages = orjson.loads(response.content)
 
                     # Get first customer message as subject
                     customer_msg = next((m for m in messages if m.get('is_customer')), None)
@@ -238,61 +409,109 @@ class XMPPClient:
                         'message_count': len(messages)
                     })
                 else:
-                    print(f"⚠️  Could not fetch messages for ticket {ticket_id[:8]}: {response.status_code}")
+                    logger.warning("⚠️  Could not fetch messages for ticket %.8s: %s", ticket_id, response.status_code)
 
             except Exception as e:
-                print(f"⚠️  Error fetching ticket {ticket_id[:8]}: {e}")
+                logger.warning("⚠️  Error fetching ticket %.8s: %s", ticket_id, e)
 
-        print(f"📋 Found {len(tickets)} active tickets")
+        logger.debug("📋 Found %d active tickets", len(tickets))
         return tickets
 
     def send_ticket_response(self, ticket_id, response_text, to_jid=None):
         """Send response to a ticket and notify user via XMPP"""
-        if not self.api_base_url or not self.api_token:
-            print("⚠️  API not configured")
+        if not self._api_enabled:
+            logger.warning("⚠️  API not configured")
             return False
 
         try:
-            url = f"{self.api_base_url}/api/v1/tickets/{ticket_id}/respond"
-            headers = {
-                'Authorization': f'Bearer {self.api_token}',
-                'Content-Type': 'application/json'
-            }
+            url = f"{self._api_root}/tickets/{ticket_id}/respond"
             payload = {
                 'response': response_text,
-                'timestamp': datetime.now().isoformat() + 'Z'
+                'timestamp': _utc_iso()
             }
 
-            print(f"\n📤 Sending response to ticket #{ticket_id}")
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            logger.info("📤 Sending response to ticket #%s", ticket_id)
+            response = self.session.post(url, data=orjson.dumps(payload), timeout=API_TIMEOUT)
 
             if response.status_code == 200:
-                print(f"   ✅ Response saved to ticket #{ticket_id}")
+                logger.info("   ✅ Response saved to ticket #%s", ticket_id)
 
                 # Send XMPP message to user if JID provided (mark as AI-sent)
                 if to_jid and self.connection:
                     self.send_message(to_jid, response_text, from_ai=True)
-                    print(f"   ✅ XMPP message sent to {to_jid}")
+                    logger.debug("   ✅ XMPP message sent to %s", to_jid)
 
                 return True
             else:
-                print(f"   ❌ Failed: {response.status_code} - {response.text}")
+                logger.error("   ❌ Failed: %s - %s", response.status_code, response.text)
                 return False
 
         except Exception as e:
-            print(f"❌ Error sending ticket response: {e}")
+            logger.error("❌ Error sending ticket response: %s", e)
             return False
 
-    def get_messages(self):
-        """Get all queued messages"""
+    def get_messages(self, timeout=None, subscriber=None):
+        """Get all queued messages
+
+        Args:
+            timeout: If set, block up to this many seconds for the first message
+            subscriber: Id from add_subscriber() to drain that consumer's own queue
+        """
+        if subscriber is None:
+            message_queue, event = self.message_queue, self._message_event
+        else:
+            sub = self._subscribers.get(subscriber)
+            if sub is None:
+                return []
+            sub['drained_at'] = time.monotonic()
+            message_queue, event = sub['queue'], sub['event']
+        if timeout and not message_queue:
+            event.wait(timeout)
+        event.clear()
+
+        # deque.popleft is atomic, so no extra locking is needed against the process thread
         messages = []
-        while not self.message_queue.empty():
-            try:
-                messages.append(self.message_queue.get_nowait())
-            except queue.Empty:
-                break
+        try:
+            while True:
+                messages.append(message_queue.popleft())
+        except IndexError:
+            pass
         return messages
 
+    def add_subscriber(self):
+        """Give a new consumer its own copy of every message queued from now on
+
+        A subscriber lives until remove_subscriber(), or until it goes SUBSCRIBER_TIMEOUT
+        seconds without calling get_messages() (e.g. its browser tab was closed).
+
+        Returns:
+            int: Subscriber id for get_messages() and remove_subscriber()
+        """
+        with self._subscribers_lock:
+            subscriber = next(self._subscriber_ids)
+            sub = {'queue': deque(maxlen=MESSAGE_QUEUE_SIZE), 'event': threading.Event(), 'drained_at': time.monotonic()}
+            self._subscribers = {**self._live_subscribers(), subscriber: sub}
+        return subscriber
+
+    def remove_subscriber(self, subscriber):
+        """Stop queueing messages for a consumer
+
+        Returns:
+            int: Number of (live) subscribers left
+        """
+        with self._subscribers_lock:
+            self._subscribers = {k: v for k, v in self._live_subscribers().items() if k != subscriber}
+            return len(self._subscribers)
+
+    def is_subscribed(self, subscriber):
+        """Whether subscriber is still registered (it is dropped after SUBSCRIBER_TIMEOUT idle seconds)"""
+        return subscriber in self._subscribers
+
+    def _live_subscribers(self):
+        """Subscribers that drained within SUBSCRIBER_TIMEOUT (caller holds _subscribers_lock)"""
+        now = time.monotonic()
+        return {k: v for k, v in self._subscribers.items() if now - v['drained_at'] < SUBSCRIBER_TIMEOUT}
+
     def is_connected(self):
         """Check if connected"""
         return self.connection is not None and not self.stop_event.is_set()
@@ -300,12 +519,23 @@ class XMPPClient:
     def get_roster(self):
         """Get list of contacts from XMPP roster with fallback strategies
 
+        The result is reused for ROSTER_CACHE_TTL seconds, or until a new contact
+        is discovered.
+
         Returns:
             list: List of dicts with 'jid', 'name', and 'subscription' keys
         """
         if not self.connection:
             return []
 
+        cached_at, contacts = self._roster_cache
+        if contacts is None or time.monotonic() - cached_at >= ROSTER_CACHE_TTL:
+            contacts = self._load_roster()
+            self._roster_cache = (time.monotonic(), contacts)
+        return list(contacts)
+
+    def _load_roster(self):
+        """Build the contact list for get_roster"""
         contacts = []
 
         # Strategy 1: Try to get from XMPP roster (may fail with XML errors)
@@ -331,11 +561,11 @@ class XMPPClient:
                         contacts.sort(key=lambda x: x['name'].lower())
                         return contacts
         except Exception as e:
-            print(f"Roster unavailable (this is OK): {e}")
+            logger.debug("Roster unavailable (this is OK): %s", e)
 
         # Strategy 2: Use discovered contacts from presence/messages
         if self.discovered_contacts:
-            print(f"Using {len(self.discovered_contacts)} discovered contacts")
+            logger.debug("Using %d discovered contacts", len(self.discovered_contacts))
             for jid in sorted(self.discovered_contacts):
                 contacts.append({
                     'jid': jid,
@@ -346,19 +576,14 @@ class XMPPClient:
 
         # Strategy 3: Get contacts from message log directories
         try:
-            if os.path.exists(self.log_dir):
-                # Look for current username folder (just username, not full JID)
-                bare_jid = self.jid.split('/')[0]
-                current_username = bare_jid.split('@')[0]
-                jid_log_dir = os.path.join(self.log_dir, current_username)
-
-                if os.path.exists(jid_log_dir):
-                    # Get person folders under current JID folder
-                    for folder in os.listdir(jid_log_dir):
-                        folder_path = os.path.join(jid_log_dir, folder)
-                        if os.path.isdir(folder_path):
+            # Look for current username folder (just username, not full JID)
+            if os.path.exists(self._jid_log_dir):
+                # Get person folders under current JID folder
+                with os.scandir(self._jid_log_dir) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
                             # Convert folder name back to JID
-                            jid = folder.replace('_at_', '@')
+                            jid = entry.name.replace('_at_', '@')
                             contacts.append({
                                 'jid': jid,
                                 'name': jid.split('@')[0],
@@ -367,12 +592,12 @@ class XMPPClient:
 
             if contacts:
                 contacts.sort(key=lambda x: x['name'].lower())
-                print(f"Using {len(contacts)} contacts from message logs")
+                logger.debug("Using %d contacts from message logs", len(contacts))
                 return contacts
         except Exception as e:
-            print(f"Error reading log directories: {e}")
+            logger.warning("Error reading log directories: %s", e)
 
-        print("No contacts found")
+        logger.debug("No contacts found")
         return []
 
     def _message_handler(self, conn, msg):
@@ -385,29 +610,71 @@ class XMPPClient:
         if not body:
             return
 
+        # Skip redelivered stanzas so they aren't logged or posted to the API twice
+        stanza_id = msg.getID()
+        if stanza_id:
+            key = (sender, stanza_id, hash(body))
+            now_mono = time.monotonic()
+            seen_at = self._recent_stanzas.get(key)
+            if seen_at is not None and now_mono - seen_at < RECENT_STANZA_TTL:
+                return
+            self._recent_stanzas.pop(key, None)  # Expired entry: re-added as the newest
+            self._recent_stanzas[key] = now_mono
+            # Oldest first: drop expired entries, and the oldest beyond the size limit
+            while self._recent_stanzas:
+                oldest_key, oldest_at = next(iter(self._recent_stanzas.items()))
+                if now_mono - oldest_at < RECENT_STANZA_TTL and len(self._recent_stanzas) <= RECENT_STANZA_LIMIT:
+                    break
+                del self._recent_stanzas[oldest_key]
+
         # Track this contact (bare JID without resource)
         bare_jid = sender.split('/')[0]
-        if bare_jid and '@' in bare_jid:
+        if bare_jid and '@' in bare_jid and bare_jid not in self.discovered_contacts:
             self.discovered_contacts.add(bare_jid)
+            self._roster_cache = (0.0, None)
 
-        # Log received message
-        recipient = str(msg.getTo()) if msg.getTo() else self.jid
-        self._log_message(sender, recipient, body, 'received')
-
-        # Get optional metadata (can be enhanced later to fetch from roster/vCard)
-        sender_metadata = self._get_sender_metadata(sender)
+        # One timestamp for the log line, webhook payload and UI queue
+        now = datetime.now()
 
-        # Send to API webhook if configured
-        self._send_to_api(sender, recipient, body, msg_type, sender_metadata)
+        # Log received message
+        self._log_message(sender, body, 'received', now=now)
+
+        # Send to API webhook if configured (on a worker thread, so Process() keeps running)
+        if self._api_enabled:
+            # Get optional metadata (can be enhanced later to fetch from roster/vCard)
+            sender_metadata = self._get_sender_metadata(sender)
+            to = msg.getTo()
+            recipient = str(to) if to else self.jid
+            future = self._api_pool.submit(self._send_to_api, sender, recipient, body, msg_type, sender_metadata, now)
+            with self._api_pending_lock:
+                self._api_pending.add(future)
+            future.add_done_callback(self._api_post_done)
 
         # Add to queue
-        self.message_queue.put({
+        self._queue_message({
             'from': sender,
             'body': body,
             'type': msg_type,
-            'timestamp': datetime.now().timestamp()
+            'timestamp': now.timestamp(),
+            'id': stanza_id  # XMPP stanza id (None if the sender set none)
         })
 
+    def _queue_message(self, entry):
+        """Hand an entry to get_messages"""
+        subscribers = self._subscribers
+        if subscribers:
+            now = time.monotonic()
+            if any(now - sub['drained_at'] >= SUBSCRIBER_TIMEOUT for sub in subscribers.values()):
+                # Drop abandoned subscribers instead of filling their queues
+                with self._subscribers_lock:
+                    self._subscribers = subscribers = self._live_subscribers()
+        if not subscribers:
+            self.message_queue.append(entry)
+            self._message_event.set()
+        for sub in subscribers.values():
+            sub['queue'].append(entry)
+            sub['event'].set()
+
     def _presence_handler(self, conn, pres):
         """Handle presence updates"""
         sender = str(pres.getFrom())
@@ -416,29 +683,126 @@ class XMPPClient:
 
         # Track this contact (bare JID without resource)
         bare_jid = sender.split('/')[0]
-        if bare_jid and '@' in bare_jid and bare_jid != self.jid:
+        if bare_jid and '@' in bare_jid and bare_jid != self.jid and bare_jid not in self.discovered_contacts:
             self.discovered_contacts.add(bare_jid)
+            self._roster_cache = (0.0, None)
 
-        self.message_queue.put({
+        self._queue_message({
             'from': sender,
             'body': f"[Presence: {pres_type or 'available'}] {status or ''}",
             'type': 'presence',
-            'timestamp': datetime.now().timestamp()
+            'timestamp': time.time()
         })
 
     def _process_loop(self):
-        """Background thread to process XMPP events"""
+        """Background thread to process XMPP events, sleeping in select() until the
+        server sends data or disconnect() wakes it"""
+        transport = self.connection.Connection
+        sock = getattr(transport, '_sslObj', None) or transport._sock
         try:
-            while not self.stop_event.is_set():
-                self.connection.Process(1)
+            with selectors.DefaultSelector() as selector:
+                selector.register(sock, selectors.EVENT_READ)
+                selector.register(self._wake_r, selectors.EVENT_READ)
+                while not self.stop_event.is_set():
+                    # With TLS, decrypted data may already be buffered where select() can't see it
+                    if not transport.pending_data(0):
+                        selector.select()
+                        if self.stop_event.is_set():
+                            break
+                    self.connection.Process(0)
         except Exception as e:
-            self.message_queue.put({
+            self._queue_message({
                 'from': 'System',
                 'body': f"Error: {str(e)}",
                 'type': 'error',
-                'timestamp': datetime.now().timestamp()
+                'timestamp': time.time()
             })
 
+    def _log_writer_loop(self):
+        """Background thread to write queued log lines to disk until a None sentinel arrives"""
+        running = True
+        while running:
+            batch = self._drain_log_queue([self._log_queue.get()])
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+            self._write_log_lines(batch)
+
+        self._close_log_fds()
+
+    def _drain_log_queue(self, batch=None):
+        """Take queued items without blocking until the batch holds LOG_BATCH_SIZE"""
+        batch = batch or []
+        try:
+            while len(batch) < LOG_BATCH_SIZE:
+                batch.append(self._log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write_log_lines(self, batch):
+        """Write (filepath, encoded line) items, one unbuffered append per log file"""
+        by_file = {}
+        for filepath, line in batch:
+            by_file.setdefault(filepath, []).append(line)
+
+        with self._log_write_lock:
+            for filepath, lines in by_file.items():
+                try:
+                    os.write(self._get_log_fd(filepath), b''.join(lines))
+                except Exception:
+                    pass  # Silently fail, same as _log_message
+
+    def _get_log_fd(self, filepath):
+        """Get the open log file descriptor for filepath, closing the conversation's
+        previous file if it rotated (new day or ticket closed)
+
+        At most LOG_FD_CACHE_SIZE files stay open (least recently written are closed
+        first), and all of them are closed when the date changes.
+        """
+        date_str = os.path.basename(filepath)[:10]  # Files are YYYY-MM-DD_NNN.txt
+        if date_str != self._log_fds_date:
+            self._close_cached_fds()
+            self._log_fds_date = date_str
+
+        person_dir = os.path.dirname(filepath)
+        cached = self._log_fds.get(person_dir)
+        if cached:
+            if cached[0] == filepath:
+                self._log_fds.move_to_end(person_dir)
+                return cached[1]
+            del self._log_fds[person_dir]
+            os.close(cached[1])
+        fd = os.open(filepath, LOG_FILE_FLAGS, 0o644)
+        self._log_fds[person_dir] = (filepath, fd)
+        while len(self._log_fds) > LOG_FD_CACHE_SIZE:
+            _, (_, old_fd) = self._log_fds.popitem(last=False)
+            os.close(old_fd)
+        return fd
+
+    def _close_log_fds(self):
+        """Close all cached log file descriptors"""
+        with self._log_write_lock:
+            self._close_cached_fds()
+
+    def _close_cached_fds(self):
+        """Close all cached log file descriptors (caller holds _log_write_lock)"""
+        for _, fd in self._log_fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._log_fds.clear()
+
+    def _flush_logs(self):
+        """Write everything still queued and close the log files (used on disconnect)"""
+        while True:
+            batch = [item for item in self._drain_log_queue() if item is not None]
+            if not batch:
+                break
+            self._write_log_lines(batch)
+        self._close_log_fds()
+
     def _get_sender_metadata(self, sender_jid):
         """Get metadata about sender from XMPP roster/vCard
 
@@ -447,20 +811,25 @@ class XMPPClient:
         - sender_email: Email from vCard
         - sender_groups: Roster groups the sender belongs to
 
+        Results are cached per bare JID for METADATA_TTL seconds; if a lookup
+        fails, the last cached value is returned regardless of age.
+
         Note: This is a basic implementation. Can be enhanced to:
         1. Query vCard for full name and email
         2. Query roster for groups
-        3. Cache results to avoid repeated lookups
         """
         metadata = {}
 
+        # Get bare JID (without resource)
+        bare_jid = sender_jid.split('/')[0]
+        cached = self._metadata_cache.get(bare_jid)
+        if cached and time.monotonic() - cached[0] < METADATA_TTL:
+            return cached[1]
+
         try:
             if not self.connection:
                 return metadata
 
-            # Get bare JID (without resource)
-            bare_jid = sender_jid.split('/')[0]
-
             # Try to get roster item
             roster = self.connection.getRoster()
             if roster:
@@ -480,13 +849,34 @@ class XMPPClient:
             # This requires implementing vCard IQ queries
             # For now, metadata extraction from roster only
 
+            self._metadata_cache[bare_jid] = (time.monotonic(), metadata)
+
         except Exception as e:
             # Silently fail - metadata is optional
-            print(f"   ⚠️  Could not fetch metadata for {sender_jid}: {e}")
+            logger.warning("   ⚠️  Could not fetch metadata for %s: %s", sender_jid, e)
+            if cached:
+                return cached[1]  # Stale is better than nothing
 
         return metadata
 
-    def _send_to_api(self, from_jid, to_jid, body, msg_type, sender_metadata=None):
+    def _api_post_done(self, future):
+        """Forget a finished webhook post"""
+        with self._api_pending_lock:
+            self._api_pending.discard(future)
+
+    def _flush_api_posts(self):
+        """Give queued webhook posts up to API_FLUSH_TIMEOUT seconds, then drop the rest"""
+        self._api_pool.shutdown(wait=False)
+        with self._api_pending_lock:
+            pending = list(self._api_pending)
+        _, not_done = wait_futures(pending, timeout=API_FLUSH_TIMEOUT)
+        dropped = sum(1 for future in not_done if future.cancel())
+        if dropped:
+            logger.warning("⚠️  Dropped %d webhook post(s) still queued after %ss on disconnect", dropped, API_FLUSH_TIMEOUT)
+        if len(not_done) > dropped:
+            logger.warning("⚠️  %d webhook post(s) still in flight on disconnect", len(not_done) - dropped)
+
+    def _send_to_api(self, from_jid, to_jid, body, msg_type, sender_metadata=None, now=None):
         """Send incoming message to API webhook
 
         Args:
@@ -495,17 +885,14 @@ class XMPPClient:
             body: Message content (REQUIRED)
             msg_type: Message type (default: 'chat')
             sender_metadata: Optional dict with sender_name, sender_email, sender_groups
+            now: Optional datetime the message was received (default: current time)
         """
-        if not self.api_base_url or not self.api_token:
-            print("⚠️  API not configured (missing API_BASE_URL or API_TOKEN)")
+        if not self._api_enabled:
+            logger.debug("API not configured (missing API_BASE_URL or API_TOKEN)")
             return
 
         try:
-            url = f"{self.api_base_url}/api/v1/webhooks/xmpp/incoming"
-            headers = {
-                'Authorization': f'Bearer {self.api_token}',
-                'Content-Type': 'application/json'
-            }
+            url = self._url_incoming
 
             # Required fields
             payload = {
@@ -513,7 +900,7 @@ class XMPPClient:
                 'to_jid': to_jid,
                 'body': body,
                 'message_type': msg_type,
-                'timestamp': datetime.now().isoformat() + 'Z'
+                'timestamp': _utc_iso(now)
             }
 
             # Optional fields - only include if provided
@@ -527,23 +914,16 @@ class XMPPClient:
                 if sender_metadata.get('thread_id'):
                     payload['thread_id'] = sender_metadata['thread_id']
 
-            print(f"\n📤 Sending message to API webhook")
-            print(f"   URL: {url}")
-            print(f"   From: {from_jid}")
-            print(f"   To: {to_jid}")
-            print(f"   Body: {body[:50]}..." if len(body) > 50 else f"   Body: {body}")
-            print(f"   Headers: Authorization: Bearer {self.api_token[:20]}...")
+            logger.debug("📤 POST %s from=%s to=%s body=%.50r", url, from_jid, to_jid, body)
 
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            response = self.session.post(url, data=orjson.dumps(payload), timeout=API_TIMEOUT)
 
-            print(f"\n📥 API Response:")
-            print(f"   Status Code: {response.status_code}")
+            logger.debug("📥 API response: %s", response.status_code)
 
             if response.status_code == 200:
-                print(f"   ✅ SUCCESS - Message delivered to backend")
                 try:
-                    response_data = response.json()
-                    print(f"   Response: {response_data}")
+                    response_data = orjson.loads(response.content)
+                    logger.debug("   Response: %s", response_data)
 
                     # Extract ticket_id and start monitoring
                     ticket_id = response_data.get('ticket_id')
@@ -552,136 +932,209 @@ class XMPPClient:
                         bare_jid = from_jid.split('/')[0]  # Remove resource
                         full_jid = from_jid  # Keep resource for API calls
 
-                        print(f"\n🔍 JID Debug:")
-                        print(f"   Full JID sent to backend: {full_jid}")
-                        print(f"   Bare JID for monitoring: {bare_jid}")
-
-                        # Start monitoring this ticket if not already monitoring
-                        if bare_jid not in self.polling_threads or not self.polling_threads[bare_jid].is_alive():
-                            print(f"\n👀 Starting ticket monitor for {bare_jid} (ticket {ticket_id})")
-                            self.user_tickets[bare_jid] = {
-                                'ticket_id': ticket_id,
-                                'last_message_count': 0,
-                                'status': 'OPEN',
-                                'full_jid': full_jid  # Store for API calls if needed
-                            }
-
-                            # Start background polling thread
-                            poll_thread = threading.Thread(
-                                target=self._monitor_ticket_until_resolved,
-                                args=(bare_jid,),
-                                daemon=True
-                            )
-                            poll_thread.start()
-                            self.polling_threads[bare_jid] = poll_thread
+                        # Start monitoring this ticket if not already monitoring. Checked under
+                        # _poll_cv, so a poll that is just dropping a resolved ticket can't
+                        # discard the new one
+                        with self._poll_cv:
+                            current = self.user_tickets.get(bare_jid)
+                            is_new = current is None or current.get('ticket_id') != ticket_id
+                            if is_new:
+                                self.user_tickets[bare_jid] = {
+                                    'ticket_id': ticket_id,
+                                    'last_message_count': 0,
+                                    'status': 'OPEN',
+                                    'full_jid': full_jid  # Store for API calls if needed
+                                }
+                            self._wake_ticket_monitor(bare_jid)
+                        if is_new:
+                            logger.info("👀 Starting ticket monitor for %s (ticket %s)", bare_jid, ticket_id)
                         else:
-                            print(f"\n♻️  Already monitoring ticket for {bare_jid}")
+                            # A reply is likely on its way; don't wait out the backoff
+                            logger.debug("♻️  Already monitoring ticket for %s", bare_jid)
                 except Exception as e:
-                    print(f"   ⚠️  Error processing response: {e}")
-                    print(f"   Response: {response.text}")
-            else:
-                print(f"   ❌ FAILED - Non-200 status code")
-                print(f"   Response: {response.text}")
+                    logger.warning("⚠️  Error processing webhook response: %s (%s)", e, response.text)
 
             response.raise_for_status()
 
         except requests.exceptions.HTTPError as e:
-            print(f"\n❌ HTTP Error: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"   Status: {e.response.status_code}")
-                print(f"   Response Body: {e.response.text}")
+            logger.error("❌ Webhook HTTP error: %s - %s", e, e.response.text if e.response is not None else '')
         except requests.exceptions.ConnectionError as e:
-            print(f"\n❌ Connection Error: Cannot reach {url}")
-            print(f"   Details: {e}")
+            logger.error("❌ Webhook connection error: cannot reach %s (%s)", url, e)
         except requests.exceptions.Timeout as e:
-            print(f"\n❌ Timeout Error: Request took longer than 10 seconds")
-            print(f"   Details: {e}")
+            logger.error("❌ Webhook timeout: %s", e)
         except requests.exceptions.RequestException as e:
-            print(f"\n❌ Request Error: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"   Status: {e.response.status_code}")
-                print(f"   Response: {e.response.text}")
+            logger.error("❌ Webhook request error: %s", e)
         except Exception as e:
-            print(f"\n❌ Unexpected error: {type(e).__name__}: {e}")
+            logger.error("❌ Unexpected webhook error: %s: %s", type(e).__name__, e)
 
-    def _monitor_ticket_until_resolved(self, user_jid):
-        """Continuously monitor a ticket until it's resolved"""
-        poll_interval = 3  # Check every 3 seconds
-        consecutive_errors = 0
-        max_errors = 5
+    def _ticket_poll_loop(self):
+        """Background thread that hands each monitored ticket to the poll pool when it is due
 
-        while not self.stop_event.is_set():
-            try:
-                # Get ticket info (from cache)
-                if user_jid not in self.user_tickets:
-                    print(f"\n✅ Ticket monitor stopped - no cached ticket for {user_jid}")
-                    break
+        Due times live in a min-heap of (due, jid) entries. An entry whose due time no
+        longer matches the ticket's state has been superseded and is skipped. A ticket
+        is polled every POLL_MIN_INTERVAL seconds while replies are arriving and its
+        interval doubles (up to POLL_MAX_INTERVAL) on each empty poll or error. A new
+        customer message resets it via _wake_ticket_monitor.
+        """
+        with self._poll_cv:
+            while not self.stop_event.is_set():
+                if not self._poll_heap:
+                    self._poll_cv.wait()
+                    continue
+                due, user_jid = self._poll_heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._poll_cv.wait(delay)
+                    continue
+
+                heapq.heappop(self._poll_heap)
+                poll = self._ticket_polls.get(user_jid)
+                if poll is None or poll['running'] or poll['due'] != due:
+                    continue
+                poll['running'] = True
+                self._poll_pool.submit(self._run_ticket_poll, user_jid, poll)
+
+    def _schedule_ticket_poll(self, user_jid, poll, delay):
+        """Queue the ticket's next poll (caller holds _poll_cv)"""
+        poll['due'] = time.monotonic() + delay
+        heapq.heappush(self._poll_heap, (poll['due'], user_jid))
+        self._poll_cv.notify()
+
+    def _run_ticket_poll(self, user_jid, poll):
+        """Poll one ticket on the poll pool, then schedule its next poll"""
+        keep = self._poll_ticket(user_jid, poll)
+        with self._poll_cv:
+            poll['running'] = False
+            if self._ticket_polls.get(user_jid) is not poll:
+                return  # Dropped by disconnect()
+            if not keep and poll['woken'] and user_jid in self.user_tickets:
+                # The ticket ended, but a new one was opened mid-poll: monitor that instead
+                keep = True
+                poll['errors'] = 0
+            if keep:
+                if poll['woken']:
+                    # A customer message arrived mid-poll; check again right away
+                    poll['woken'] = False
+                    poll['interval'] = POLL_MIN_INTERVAL
+                    self._schedule_ticket_poll(user_jid, poll, 0)
+                else:
+                    self._schedule_ticket_poll(user_jid, poll, poll['interval'])
+            else:
+                del self._ticket_polls[user_jid]
+        if not keep:
+            logger.info("📴 Stopped monitoring %s", user_jid)
+
+    def _wake_ticket_monitor(self, user_jid):
+        """Start monitoring user_jid's ticket, or poll it now at the fastest interval"""
+        with self._poll_cv:
+            poll = self._ticket_polls.get(user_jid)
+            if poll is None:
+                poll = {'due': 0, 'interval': POLL_MIN_INTERVAL, 'errors': 0, 'running': False, 'woken': False}
+                self._ticket_polls[user_jid] = poll
+            poll['interval'] = POLL_MIN_INTERVAL
+            if poll['running']:
+                poll['woken'] = True
+            else:
+                self._schedule_ticket_poll(user_jid, poll, 0)
 
-                ticket_id = self.user_tickets[user_jid].get('ticket_id')
-                status = self.user_tickets[user_jid].get('status', 'OPEN')
+    def _drop_ticket(self, user_jid, ticket_id):
+        """Forget user_jid's ticket, unless it was replaced by a new ticket meanwhile"""
+        with self._poll_cv:
+            current = self.user_tickets.get(user_jid)
+            if current is not None and current.get('ticket_id') == ticket_id:
+                del self.user_tickets[user_jid]
 
-                print(f"   🔄 Polling ticket {ticket_id[:8]}... (status: {status})")
+    def _poll_ticket(self, user_jid, poll):
+        """Check a ticket for new replies and forward them to the user
 
-                # Check if ticket is resolved/closed
-                if status in ['RESOLVED', 'CLOSED']:
-                    print(f"\n✅ Ticket {ticket_id} {status} for {user_jid}")
-                    self.user_tickets.pop(user_jid, None)
-                    break
+        Args:
+            user_jid: Bare JID of the customer
+            poll: The ticket's polling state ('interval' and 'errors' are updated)
 
-                # Check for new messages
-                new_messages = self._get_new_ticket_messages(user_jid, ticket_id)
+        Returns:
+            bool: False once the ticket is resolved or keeps failing
+        """
+        max_errors = 5
 
-                if new_messages is None:
-                    # Error fetching messages
-                    consecutive_errors += 1
-                    if consecutive_errors >= max_errors:
-                        print(f"\n⚠️  Too many errors polling {user_jid} - stopping monitor")
-                        self.user_tickets.pop(user_jid, None)
-                        break
-                else:
-                    consecutive_errors = 0  # Reset error count
+        try:
+            # Get ticket info (from cache)
+            ticket_info = self.user_tickets.get(user_jid)
+            if ticket_info is None:
+                logger.info("✅ Ticket monitor stopped - no cached ticket for %s", user_jid)
+                return False
 
-                    for msg in new_messages:
-                        content = msg.get('content')
-                        msg_type = msg.get('message_type')  # "AGENT" or "AI"
-                        sender = msg.get('sender', 'Unknown')
-                        is_customer = msg.get('is_customer', False)
+            ticket_id = ticket_info.get('ticket_id')
+            status = ticket_info.get('status', 'OPEN')
 
-                        # Only send non-customer messages (AI/AGENT responses)
-                        if not is_customer and content:
-                            print(f"\n🤖 [{msg_type}] {sender}: New response for {user_jid}")
-                            print(f"   {content[:100]}...")
-                            # Mark as AI-sent so it shows as "AI Bot" in logs
-                            self.send_message(user_jid, content, from_ai=True)
-                            print(f"   ✅ Sent to {user_jid}")
+            logger.debug("   🔄 Polling ticket %.8s... (status: %s)", ticket_id, status)
 
-                        # Check if this message indicates ticket is resolved
-                        if msg.get('ticket_status') in ['RESOLVED', 'CLOSED']:
-                            self.user_tickets[user_jid]['status'] = msg.get('ticket_status')
+            # Check if ticket is resolved/closed
+            if status in ['RESOLVED', 'CLOSED']:
+                logger.info("✅ Ticket %s %s for %s", ticket_id, status, user_jid)
+                self._drop_ticket(user_jid, ticket_id)
+                return False
 
-                time.sleep(poll_interval)
+            # Check for new messages
+            new_messages = self._get_new_ticket_messages(user_jid, ticket_id)
+
+            if new_messages is None:
+                # Error fetching messages
+                poll['errors'] += 1
+                if poll['errors'] >= max_errors:
+                    logger.warning("⚠️  Too many errors polling %s - stopping monitor", user_jid)
+                    self._drop_ticket(user_jid, ticket_id)
+                    return False
+                poll['interval'] = min(poll['interval'] * 2, POLL_MAX_INTERVAL)
+                return True
 
-            except Exception as e:
-                print(f"\n⚠️  Monitor error for {user_jid}: {e}")
-                consecutive_errors += 1
-                if consecutive_errors >= max_errors:
-                    print(f"\n⚠️  Too many errors - stopping monitor for {user_jid}")
-                    self.user_tickets.pop(user_jid, None)
-                    break
-                time.sleep(poll_interval * 2)  # Back off on errors
+            poll['errors'] = 0  # Reset error count
+            if new_messages:
+                poll['interval'] = POLL_MIN_INTERVAL
+            else:
+                poll['interval'] = min(poll['interval'] * 2, POLL_MAX_INTERVAL)
+
+            for msg in new_messages:
+                content = msg.get('content')
+                msg_type = msg.get('message_type')  # "AGENT" or "AI"
+                sender = msg.get('sender', 'Unknown')
+                is_customer = msg.get('is_customer', False)
+
+                # Only send non-customer messages (AI/AGENT responses)
+                if not is_customer and content:
+                    logger.info("🤖 [%s] %s: New response for %s", msg_type, sender, user_jid)
+                    logger.debug("   %.100s...", content)
+                    # Mark as AI-sent so it shows as "AI Bot" in logs
+                    self.send_message(user_jid, content, from_ai=True)
+                    logger.debug("   ✅ Sent to %s", user_jid)
+
+                # Check if this message indicates ticket is resolved
+                if msg.get('ticket_status') in ['RESOLVED', 'CLOSED']:
+                    with self._poll_cv:
+                        current = self.user_tickets.get(user_jid)
+                        if current is not None and current.get('ticket_id') == ticket_id:
+                            self.user_tickets[user_jid] = {**current, 'status': msg.get('ticket_status')}
 
-        print(f"📴 Stopped monitoring {user_jid}")
+        except Exception as e:
+            logger.warning("⚠️  Monitor error for %s: %s", user_jid, e)
+            poll['errors'] += 1
+            if poll['errors'] >= max_errors:
+                logger.warning("⚠️  Too many errors - stopping monitor for %s", user_jid)
+                self._drop_ticket(user_jid, ticket_id)
+                return False
+            poll['interval'] = min(poll['interval'] * 2, POLL_MAX_INTERVAL)  # Back off on errors
+
+        return True
 
     def _get_active_ticket(self, user_jid):
         """Check if user has an active ticket"""
-        if not self.api_base_url or not self.api_token:
+        if not self._api_enabled:
             return None
 
         # First check if we already have ticket info stored locally
-        if user_jid in self.user_tickets:
-            ticket_info = self.user_tickets[user_jid]
+        ticket_info = self.user_tickets.get(user_jid)
+        if ticket_info is not None:
             ticket_id = ticket_info.get('ticket_id')
-            print(f"   📦 Using cached ticket: {ticket_id}")
+            logger.debug("   📦 Using cached ticket: %s", ticket_id)
 
             # Simply return cached info - we'll check messages to determine if still active
             return ticket_info
@@ -689,29 +1142,24 @@ class XMPPClient:
         # If not cached, try querying by JID
         try:
             # Try bare JID first
-            url = f"{self.api_base_url}/api/v1/webhooks/xmpp/user/{user_jid}/active-ticket"
-            headers = {
-                'Authorization': f'Bearer {self.api_token}',
-                'Content-Type': 'application/json'
-            }
+            url = f"{self._url_xmpp}/user/{user_jid}/active-ticket"
 
-            print(f"   🔍 Checking active ticket: {url}")
-            response = requests.get(url, headers=headers, timeout=10)
+            logger.debug("   🔍 Checking active ticket: %s", url)
+            response = self.session.get(url, timeout=API_TIMEOUT)
 
             if response.status_code == 200:
-                ticket_data = response.json()
-                print(f"   🎫 Active ticket for {user_jid}: {ticket_data.get('ticket_id') if ticket_data else 'None'}")
+                ticket_data = orjson.loads(response.content)
+                logger.debug("   🎫 Active ticket for %s: %s", user_jid, ticket_data.get('ticket_id') if ticket_data else None)
                 return ticket_data if ticket_data else None
             elif response.status_code == 404:
-                print(f"   ℹ️  No active ticket found for {user_jid}")
+                logger.debug("   ℹ️  No active ticket found for %s", user_jid)
                 return None
             else:
-                print(f"⚠️  Error checking active ticket: {response.status_code}")
-                print(f"   Response: {response.text}")
+                logger.warning("⚠️  Error checking active ticket: %s - %s", response.status_code, response.text)
                 return None
 
         except Exception as e:
-            print(f"⚠️  Error checking active ticket: {e}")
+            logger.warning("⚠️  Error checking active ticket: %s", e)
             return None
 
     def _get_new_ticket_messages(self, user_jid, ticket_id):
@@ -721,44 +1169,42 @@ class XMPPClient:
             list: New messages (empty list if none)
             None: On error
         """
-        if not self.api_base_url or not self.api_token:
+        if not self._api_enabled:
             return []
 
         try:
-            url = f"{self.api_base_url}/api/v1/webhooks/xmpp/tickets/{ticket_id}/messages"
-            headers = {
-                'Authorization': f'Bearer {self.api_token}',
-                'Content-Type': 'application/json'
-            }
+            url = f"{self._url_tickets}/{ticket_id}/messages"
 
-            response = requests.get(url, headers=headers, params={'limit': 20}, timeout=10)
+            response = self.session.get(url, params={'limit': 20}, timeout=API_TIMEOUT)
 
             if response.status_code == 200:
-                messages = response.json()
+                messages = orjson.loads(response.content)
 
-                # Get count of messages we've already seen
-                last_count = self.user_tickets[user_jid].get('last_message_count', 0)
-                total_messages = len(messages)
+                with self._poll_cv:
+                    # Get count of messages we've already seen
+                    ticket_info = self.user_tickets.get(user_jid)
+                    if ticket_info is None or ticket_info.get('ticket_id') != ticket_id:
+                        return []  # Ticket ended or was replaced while fetching
+                    last_count = ticket_info.get('last_message_count', 0)
+                    total_messages = len(messages)
 
-                print(f"   📊 {total_messages} total msg, {last_count} seen, {total_messages - last_count} new")
+                    logger.debug("   📊 %d total msg, %d seen, %d new", total_messages, last_count, total_messages - last_count)
 
-                # Only return new messages (ones we haven't sent yet)
-                if total_messages > last_count:
-                    new_messages = messages[last_count:]
-                    self.user_tickets[user_jid]['last_message_count'] = total_messages
-                    return new_messages
+                    # Only return new messages (ones we haven't sent yet)
+                    if total_messages > last_count:
+                        self.user_tickets[user_jid] = {**ticket_info, 'last_message_count': total_messages}
+                        return messages[last_count:]
 
                 return []  # No new messages
             elif response.status_code == 404:
-                print(f"   ⚠️  Ticket {ticket_id[:8]}... not found (404)")
+                logger.warning("   ⚠️  Ticket %.8s... not found (404)", ticket_id)
                 return None  # Error - ticket not found
             else:
-                print(f"   ⚠️  Failed to fetch messages: {response.status_code}")
-                print(f"   Response: {response.text[:200]}")
+                logger.warning("   ⚠️  Failed to fetch messages: %s - %.200s", response.status_code, response.text)
                 return None  # Error
 
         except Exception as e:
-            print(f"   ⚠️  Error fetching messages: {e}")
+            logger.warning("   ⚠️  Error fetching messages: %s", e)
             return None  # Error
 
     def _convert_markdown_links(self, text):
@@ -766,47 +1212,37 @@ class XMPPClient:
 
         Converts [https://example.com](https://example.com) to https://example.com
         """
-        import re
-        # Pattern matches [text](url)
-        pattern = r'\[([^\]]+)\]\(([^\)]+)\)'
-
-        def replace_link(match):
-            link_text = match.group(1)
-            link_url = match.group(2)
-            # If text and URL are the same, just return the URL
-            if link_text == link_url:
-                return link_url
-            # Otherwise, return "text: url" format
-            return f"{link_text}: {link_url}"
-
-        return re.sub(pattern, replace_link, text)
-
-    def _log_message(self, sender, recipient, body, msg_type='received'):
-        """Save message to text file organized by current JID, then by person and date with sequential numbering"""
-        try:
-            # Determine conversation partner
-            if msg_type == 'received':
-                conversation_with = sender.split('/')[0]
-            else:
-                conversation_with = recipient.split('/')[0]
+        # Most messages have no links; skip the regex entirely
+        if '](' not in text:
+            return text
 
-            # Create folder for current logged-in user (just username, not full JID)
-            bare_jid = self.jid.split('/')[0]  # Remove resource if present
-            current_username = bare_jid.split('@')[0]  # Just the username part
-            jid_log_dir = os.path.join(self.log_dir, current_username)
-            os.makedirs(jid_log_dir, exist_ok=True)
+        return _MD_LINK_RE.sub(_md_link_to_text, text)
 
-            # Create folder for conversation partner under current JID folder
-            person_folder = conversation_with.replace('@', '_at_')
-            person_dir = os.path.join(jid_log_dir, person_folder)
-            os.makedirs(person_dir, exist_ok=True)
+    def _log_message(self, conversation_with, body, msg_type='received', now=None):
+        """Save message to text file organized by current JID, then by person and date with sequential numbering
 
-            # Get current date
-            now = datetime.now()
-            date_str = now.strftime('%Y-%m-%d')
+        Args:
+            conversation_with: The other party's JID (the sender, for received messages)
+            body: Message content
+            msg_type: 'received', 'sent' or 'ai_sent'
+            now: Optional datetime of the message (default: current time)
+        """
+        try:
+            # Create folder for conversation partner under current JID folder
+            person_folder = _jid_to_folder(conversation_with)
+            person_dir = os.path.join(self._jid_log_dir, person_folder)
+            if person_dir not in self._ensured_dirs:
+                os.makedirs(person_dir, exist_ok=True)
+                self._ensured_dirs.add(person_dir)
+
+            # Format the timestamp once; the date is its 'YYYY-MM-DD' prefix
+            if now is None:
+                now = datetime.now()
+            timestamp = now.isoformat(sep=' ', timespec='seconds')
+            date_str = timestamp[:10]
 
             # Create unique key for counter tracking (current_username/person_folder)
-            counter_key = f"{current_username}/{person_folder}"
+            counter_key = f"{self._current_username}/{person_folder}"
 
             # Initialize counter tracking for this person if needed
             if counter_key not in self.log_counters:
@@ -814,51 +1250,65 @@ class XMPPClient:
 
             # Determine current counter for today
             if date_str not in self.log_counters[counter_key]:
-                # Find highest existing counter for today
-                import glob
-                existing_files = glob.glob(os.path.join(person_dir, f"{date_str}_*.txt"))
-                if existing_files:
-                    # Extract counters from filenames
-                    counters = []
-                    for filepath in existing_files:
-                        filename = os.path.basename(filepath)
-                        # Extract counter from YYYY-MM-DD_XXX.txt
-                        try:
-                            counter_str = filename.split('_')[-1].replace('.txt', '')
-                            counters.append(int(counter_str))
-                        except (ValueError, IndexError):
-                            pass
-                    self.log_counters[counter_key][date_str] = max(counters) if counters else 1
-                else:
-                    self.log_counters[counter_key][date_str] = 1
+                # Find highest existing counter for today (files are YYYY-MM-DD_XXX.txt)
+                file_prefix = f"{date_str}_"
+                counters = []
+                with os.scandir(person_dir) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        if name.startswith(file_prefix) and name.endswith('.txt'):
+                            try:
+                                counters.append(int(name[len(file_prefix):-4]))
+                            except ValueError:
+                                pass
+                self.log_counters[counter_key][date_str] = max(counters, default=1)
 
             counter = self.log_counters[counter_key][date_str]
             filename = f"{date_str}_{counter:03d}.txt"
             filepath = os.path.join(person_dir, filename)
 
-            timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+            if msg_type == 'received':
+                speaker = conversation_with
+            else:
+                speaker = 'AI Bot' if msg_type == 'ai_sent' else 'Me'
+            line = f"({timestamp}) {speaker}: {body}\n"
 
-            # Write message to file
-            with open(filepath, 'a', encoding='utf-8') as f:
-                if msg_type == 'received':
-                    f.write(f"({timestamp}) {sender}: {body}\n")
-                elif msg_type == 'ai_sent':
-                    f.write(f"({timestamp}) AI Bot: {body}\n")
-                else:  # msg_type == 'sent'
-                    f.write(f"({timestamp}) Me: {body}\n")
+            # Queue the line; _log_writer_loop writes it out
+            self._log_queue.put((filepath, line.encode('utf-8')))
 
             # Check if this is a sent message containing "closing ticket"
             # If so, increment counter for next message
             if msg_type in ['sent', 'ai_sent'] and 'closing ticket' in body.lower():
                 self.log_counters[counter_key][date_str] += 1
-                print(f"   📝 Rotating log file for {counter_key} (ticket closed)")
+                logger.info("   📝 Rotating log file for %s (ticket closed)", counter_key)
 
         except Exception as e:
             pass  # Silently fail
 
 
+def start_console_logging(logger_name=None, level=logging.INFO):
+    """Print log records to stderr from a listener thread, so threads that log
+    never block on console I/O. Returns the listener; stop() it on exit.
+
+    Args:
+        logger_name: Logger to attach to (default: the root logger)
+        level: Level set on that logger
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    target = logging.getLogger(logger_name)
+    target.addHandler(logging.handlers.QueueHandler(log_queue))
+    target.setLevel(level)
+    listener.start()
+    return listener
+
+
 def main():
     """Command-line version"""
+    log_listener = start_console_logging()
     client = XMPPClient()
 
     # Construct JID from XMPP_USERNAME@XMPP_SERVER
@@ -876,8 +1326,8 @@ def main():
         print("\nPress Ctrl+C to disconnect")
 
         while True:
-            # Get and display new messages
-            messages = client.get_messages()
+            # Wait for and display new messages
+            messages = client.get_messages(timeout=1)
             for msg in messages:
                 if msg['type'] != 'presence':
                     print(f"{msg['from']}: {msg['body']}")
@@ -886,6 +1336,7 @@ def main():
         print("\nDisconnecting...")
     finally:
         client.disconnect()
+        log_listener.stop()
 
     return True
 
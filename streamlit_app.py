@@ -4,38 +4,305 @@ Streamlit Web UI for XMPP Client
 """
 import streamlit as st
 import os
+import tempfile
+import threading
 import time
-from src.xmpp_client import XMPPClient
+import orjson
+from collections import deque
+from dataclasses import dataclass
+from itertools import groupby, islice
+from datetime import date, datetime, timedelta
+from src.xmpp_client import XMPPClient, start_console_logging
 
 # Message log directory
 LOG_DIR = os.path.join(os.path.dirname(__file__), '.purple', 'logs')
 
+# Max messages kept in the session (older ones are still in the logs)
+MAX_SESSION_MESSAGES = 500
+
+# Session messages saved on disconnect and restored on the account's next connect
+# (stored in the account's log folder: LOG_DIR/<username>/SAVED_MESSAGES_FILE)
+SAVED_MESSAGES_FILE = 'session_messages.json'
+
+# Stanza ids remembered to drop messages redelivered after a reconnect
+MAX_SEEN_IDS = 2 * MAX_SESSION_MESSAGES
+
+# Most recent session messages rendered (the rest behind "Show earlier")
+MAX_SHOWN_MESSAGES = 200
+
+# Most recent log files offered in the date picker (the rest behind "Show all")
+MAX_DATE_OPTIONS = 50
+
+# Max conversation logs kept in memory by read_log
+MAX_CACHED_LOGS = 64
+
+# Bytes of a conversation log shown unless "Show full history" is checked
+LOG_TAIL_BYTES = 64 * 1024
+
+# First entry of the contact picker, for typing a JID by hand
+NO_CONTACT = "-- Enter JID manually below --"
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def list_log_dir(path, mtime):
+    """Return (subfolder names, .txt file names newest first) for a log directory
+
+    mtime is part of the cache key: creating or removing entries changes it.
+    """
+    folders, files = [], []
+    with os.scandir(path) as entries:
+        for e in entries:
+            if e.is_dir(follow_symlinks=False):
+                folders.append(e.name)
+            elif e.name.endswith('.txt') and e.is_file(follow_symlinks=False):
+                files.append(e.name)
+    return tuple(folders), tuple(sorted(files, reverse=True))
+
+
+@st.cache_resource
+def log_tail_cache():
+    """Text read so far per log file, shared across reruns and sessions, and the lock guarding it
+
+    Returns:
+        tuple: ({(path, full): (bytes read, text)}, threading.Lock)
+    """
+    return {}, threading.Lock()
+
+
+def read_log(path, full=False):
+    """Read a conversation log, only reading the bytes appended since the last call
+
+    Unless full is set, only about the last LOG_TAIL_BYTES are kept, starting at a line boundary.
+    """
+    cache, lock = log_tail_cache()
+    # Script threads of all sessions (and auto-refresh fragments) share the cache
+    with lock:
+        key = (path, full)
+        offset, text = cache.pop(key, (0, ''))
+        size = os.path.getsize(path)
+        if size < offset:
+            # File was replaced or truncated; start over
+            offset, text = 0, ''
+        if size > offset:
+            start = offset
+            if not full and size - offset > LOG_TAIL_BYTES:
+                start = size - LOG_TAIL_BYTES  # Skip what would be trimmed anyway
+            with open(path, 'rb') as f:
+                f.seek(start)
+                data = f.read(size - start)
+            # Only take complete lines, so a line being written is never split
+            end = data.rfind(b'\n') + 1
+            if start == offset:
+                text += data[:end].decode('utf-8')
+                offset += end
+            else:
+                # Skipped ahead: start after the first line break, dropping the partial line
+                text = data[data.find(b'\n') + 1:end].decode('utf-8')
+                if end:
+                    offset = start + end
+            if not full and len(text) > LOG_TAIL_BYTES:
+                text = text[text.find('\n', len(text) - LOG_TAIL_BYTES) + 1:]
+
+        cache[key] = (offset, text)  # Re-inserted, so the dict stays in least-recently-used order
+        while len(cache) > MAX_CACHED_LOGS:
+            cache.pop(next(iter(cache)))
+        return text
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def roster_options(client_id, _client):
+    """Contact picker for the connected client's roster, refreshed every 30 seconds
+
+    client_id (id of the client) is the cache key, so reconnecting fetches a new roster.
+
+    Returns:
+        tuple: (selectbox options, {display name: jid}); no options if the roster is empty
+    """
+    contact_options = {f"{c['name']} ({c['jid']})": c['jid'] for c in _client.get_roster()}
+    if not contact_options:
+        return [], {}
+    return [NO_CONTACT] + list(contact_options), contact_options
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def folder_jid_map(path, mtime):
+    """Map display JIDs to the person folders of a log directory (username_at_servername -> username@servername)
+
+    Keyed like list_log_dir, so the map is only rebuilt when the listing changes.
+    """
+    return {folder.replace('_at_', '@'): folder for folder in list_log_dir(path, mtime)[0]}
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def date_labels(date_files, today):
+    """Map log files (YYYY-MM-DD_NNN.txt) to human-readable names"""
+    yesterday = today - timedelta(days=1)
+    labels = {}
+
+    for filename in date_files:
+        # Parse filename: YYYY-MM-DD_NNN.txt (fixed-width date, so slice instead of splitting)
+        try:
+            if filename[10:11] != '_':
+                raise ValueError(filename)
+            counter = int(filename[11:-4])  # Get NNN
+            file_date = date.fromisoformat(filename[:10])  # Get YYYY-MM-DD
+
+            # Format display based on recency
+            if file_date == today:
+                display_name = f"📅 Today - Conversation #{counter}"
+            elif file_date == yesterday:
+                display_name = f"📅 Yesterday - Conversation #{counter}"
+            else:
+                formatted_date = file_date.strftime('%B %d, %Y')  # e.g., "October 07, 2025"
+                display_name = f"📅 {formatted_date} - Conversation #{counter}"
+
+            labels[filename] = display_name
+        except Exception:
+            # Fallback if parsing fails
+            labels[filename] = filename.replace('.txt', '')
+
+    return labels
+
+
+@dataclass
+class ChatMessage:
+    """Message kept in the session for the chat page"""
+    __slots__ = ('sender', 'body', 'type', 'timestamp')  # dataclass(slots=True) needs Python 3.10
+
+    sender: str
+    body: str
+    type: str
+    timestamp: float
+
+    @classmethod
+    def from_client(cls, entry):
+        """Build from an XMPPClient.get_messages() dict"""
+        return cls(entry.get('from', 'Unknown'), entry.get('body', ''), entry.get('type', 'chat'), entry.get('timestamp', 0.0))
+
+
+def saved_messages_path(jid):
+    """Where the session messages of the account jid are saved"""
+    username = jid.split('/')[0].split('@')[0]
+    return os.path.join(LOG_DIR, username, SAVED_MESSAGES_FILE)
+
+
+def load_saved_messages(path):
+    """Session messages saved by the last disconnect, oldest first (empty if there are none)"""
+    try:
+        with open(path, 'rb') as f:
+            return [ChatMessage.from_client(entry) for entry in orjson.loads(f.read())]
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        st.warning(f"Could not load saved messages: {e}")
+        return []
+
+
+def save_messages(path, messages):
+    """Save session messages for the next session
+
+    Written to a uniquely named temp file, then renamed, so concurrent disconnects
+    never mix their writes.
+    """
+    entries = [{'from': m.sender, 'body': m.body, 'type': m.type, 'timestamp': m.timestamp} for m in messages]
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=folder, prefix=f"{SAVED_MESSAGES_FILE}.", delete=False) as f:
+        tmp_path = f.name
+        f.write(orjson.dumps(entries))
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+@st.cache_resource
+def console_logging():
+    """Print the client's log records to the server console (set up once per process)"""
+    return start_console_logging(XMPPClient.__module__)
+
+
+console_logging()
+
 # Initialize session state
 if 'xmpp_client' not in st.session_state:
     st.session_state.xmpp_client = None
 
 if 'messages' not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_SESSION_MESSAGES)
 
 if 'connected' not in st.session_state:
     st.session_state.connected = False
 
+if 'subscriber' not in st.session_state:
+    st.session_state.subscriber = None  # Id of this session's message queue on the client
+
+if st.session_state.xmpp_client and not st.session_state.xmpp_client.is_connected():
+    # The shared connection was closed (the client stopped); show this session as disconnected
+    st.session_state.xmpp_client = None
+    st.session_state.subscriber = None
+    st.session_state.connected = False
+
+if 'seen_ids' not in st.session_state:
+    st.session_state.seen_ids = {}  # {(sender, stanza id, body hash): None}, oldest first
+
+
+def already_seen(entry):
+    """Whether a get_messages() entry with this stanza id was drained before
+
+    A new client (after reconnecting) no longer knows which stanzas the session
+    already shows, so redelivered messages are dropped here.
+    """
+    stanza_id = entry.get('id')
+    if not stanza_id:
+        return False
+    # Clients restart their id counters, so the same id with a different body is a new message
+    key = (entry.get('from'), stanza_id, hash(entry.get('body')))
+    seen = st.session_state.seen_ids
+    if key in seen:
+        return True
+    seen[key] = None
+    if len(seen) > MAX_SEEN_IDS:
+        del seen[next(iter(seen))]
+    return False
+
+
+def make_message(sender, body, msg_type):
+    """Session message stamped with the current time"""
+    return ChatMessage(sender, body, msg_type, time.time())
+
+
+@st.cache_resource
+def shared_client():
+    """XMPP client shared by all browser sessions of this server, and the lock guarding it
+
+    Each connected session is a subscriber of the client (with its own message queue);
+    the connection is closed when the last one disconnects. Sessions that stop draining
+    (closed tabs) are dropped by the client after SUBSCRIBER_TIMEOUT and no longer count.
+    """
+    return {'client': None, 'lock': threading.Lock()}
+
 
 def connect_xmpp():
     """Connect to XMPP server"""
     try:
-        client = XMPPClient(log_dir=LOG_DIR)
-        client.connect()  # Uses XMPP_RESOURCE from .env
+        shared = shared_client()
+        with shared['lock']:
+            client = shared['client']
+            if client is None or not client.is_connected():
+                client = XMPPClient(log_dir=LOG_DIR)
+                client.connect()  # Uses XMPP_RESOURCE from .env
+                shared['client'] = client
+            st.session_state.subscriber = client.add_subscriber()
 
         st.session_state.xmpp_client = client
         st.session_state.connected = True
 
-        st.session_state.messages.append({
-            'from': 'System',
-            'body': f"Connected as {client.jid}",
-            'type': 'system',
-            'timestamp': time.time()
-        })
+        if not st.session_state.messages:
+            # New session: pick up where this account's last session left off
+            st.session_state.messages.extend(load_saved_messages(saved_messages_path(client.jid)))
+        st.session_state.messages.append(make_message('System', f"Connected as {client.jid}", 'system'))
 
         return True
 
@@ -47,16 +314,24 @@ def connect_xmpp():
 def disconnect_xmpp():
     """Disconnect from XMPP server"""
     if st.session_state.xmpp_client:
-        st.session_state.xmpp_client.disconnect()
+        client = st.session_state.xmpp_client
+        shared = shared_client()
+        with shared['lock']:
+            # Other sessions keep the connection until the last one disconnects
+            if client.remove_subscriber(st.session_state.subscriber) == 0:
+                client.disconnect()
+                if shared['client'] is client:
+                    shared['client'] = None
         st.session_state.xmpp_client = None
+        st.session_state.subscriber = None
         st.session_state.connected = False
 
-        st.session_state.messages.append({
-            'from': 'System',
-            'body': 'Disconnected',
-            'type': 'system',
-            'timestamp': time.time()
-        })
+        st.session_state.messages.append(make_message('System', 'Disconnected', 'system'))
+
+        try:
+            save_messages(saved_messages_path(client.jid), st.session_state.messages)
+        except OSError as e:
+            st.warning(f"Could not save messages: {e}")
 
 
 def send_message(to_jid, body):
@@ -69,12 +344,7 @@ def send_message(to_jid, body):
         st.session_state.xmpp_client.send_message(to_jid, body)
 
         # Add directly to session state for sent messages
-        st.session_state.messages.append({
-            'from': 'Me',
-            'body': f"To {to_jid}: {body}",
-            'type': 'sent',
-            'timestamp': time.time()
-        })
+        st.session_state.messages.append(make_message('Me', f"To {to_jid}: {body}", 'sent'))
     except Exception as e:
         st.error(f"Failed to send: {str(e)}")
 
@@ -82,12 +352,6 @@ def send_message(to_jid, body):
 # Streamlit UI
 st.title("XMPP Client")
 
-# Drain message queue into session state
-if st.session_state.xmpp_client:
-    messages = st.session_state.xmpp_client.get_messages()
-    for msg in messages:
-        st.session_state.messages.append(msg)
-
 # Sidebar controls
 with st.sidebar:
     st.header("Connection")
@@ -140,22 +404,14 @@ with st.sidebar:
     st.header("Send Message")
 
     # Get roster contacts
-    roster_contacts = []
+    options_list, contact_options = [], {}
     if st.session_state.connected and st.session_state.xmpp_client:
-        roster_contacts = st.session_state.xmpp_client.get_roster()
+        client = st.session_state.xmpp_client
+        options_list, contact_options = roster_options(id(client), client)
 
     to_jid = None
 
-    if roster_contacts:
-        # Create contact options mapping
-        contact_options = {}
-        for c in roster_contacts:
-            display = f"{c['name']} ({c['jid']})"
-            contact_options[display] = c['jid']
-
-        # Add manual entry option
-        options_list = ["-- Enter JID manually below --"] + list(contact_options.keys())
-
+    if options_list:
         selected = st.selectbox(
             "To (click and type to search contacts):",
             options=options_list,
@@ -164,7 +420,7 @@ with st.sidebar:
         )
 
         # If a contact was selected from dropdown, use it
-        if selected and selected != "-- Enter JID manually below --":
+        if selected and selected != NO_CONTACT:
             to_jid = contact_options[selected]
             st.caption(f"✉️ Sending to: **{to_jid}**")
 
@@ -191,7 +447,7 @@ with st.sidebar:
 
     # Clear messages
     if st.button("Clear Messages", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.messages.clear()
         st.rerun()
 
     # Auto-refresh
@@ -200,124 +456,114 @@ with st.sidebar:
     if auto_refresh:
         refresh_interval = st.slider("Refresh interval (seconds)", 1, 10, 3)
 
-# ===== CHAT PAGE =====
-st.header("Messages")
 
-# Show message logs section
-st.subheader("Message History (from logs)")
+# ===== CHAT PAGE =====
+def chat_page():
+    """Message history and live messages; re-run on its own by auto-refresh"""
+    # Drain message queue into session state (presence updates are never shown, so not kept)
+    if st.session_state.xmpp_client:
+        client = st.session_state.xmpp_client
+        if not client.is_subscribed(st.session_state.subscriber):
+            # Dropped after going SUBSCRIBER_TIMEOUT without a drain (no auto-refresh); rejoin
+            st.session_state.subscriber = client.add_subscriber()
+            st.session_state.messages.append(make_message('System', "Messages received while this page was idle are only in the logs", 'system'))
+        new_messages = client.get_messages(subscriber=st.session_state.subscriber)
+        if new_messages:
+            st.session_state.messages.extend(
+                ChatMessage.from_client(entry) for entry in new_messages
+                if entry.get('type') != 'presence' and not already_seen(entry)
+            )
+
+    st.header("Messages")
+
+    # Show message logs section
+    st.subheader("Message History (from logs)")
+
+    # Get current logged-in username from session
+    current_username = None
+    if st.session_state.connected and st.session_state.xmpp_client:
+        current_jid = st.session_state.xmpp_client.jid
+        if current_jid:
+            current_username = current_jid.split('/')[0].split('@')[0]
 
-# Get current logged-in username from session
-current_username = None
-if st.session_state.connected and st.session_state.xmpp_client:
-    current_jid = st.session_state.xmpp_client.jid
-    if current_jid:
-        current_username = current_jid.split('/')[0].split('@')[0]
+    # Only show logs for current logged-in user
+    jid_display = {}
+    if current_username:
+        jid_log_dir = os.path.join(LOG_DIR, current_username)
+        # One stat per run; a missing folder (nothing logged yet, or no LOG_DIR) skips the listing
+        try:
+            mtime = os.stat(jid_log_dir).st_mtime
+        except FileNotFoundError:
+            pass
+        else:
+            # Person folders under current username, keyed by display JID
+            jid_display = folder_jid_map(jid_log_dir, mtime)
+
+    if jid_display:
+        selected_jid = st.selectbox("Select conversation:", list(jid_display.keys()))
+
+        if selected_jid:
+            person_dir = os.path.join(jid_log_dir, jid_display[selected_jid])
+
+            # Get all date files for this person
+            date_files = list_log_dir(person_dir, os.stat(person_dir).st_mtime)[1]
+
+            if len(date_files) > MAX_DATE_OPTIONS:
+                if not st.checkbox(f"Show all {len(date_files)} conversations", key=f"all_dates_{selected_jid}"):
+                    date_files = date_files[:MAX_DATE_OPTIONS]
+
+            if date_files:
+                # Show human-readable names for the files
+                labels = date_labels(date_files, datetime.now().date())
+
+                selected_date = st.selectbox("Select date:", date_files, format_func=labels.__getitem__)
+
+                if selected_date:
+                    log_path = os.path.join(person_dir, selected_date)
+                    show_full = st.checkbox("Show full history", key=f"full_log_{selected_jid}")
+                    log_content = read_log(log_path, full=show_full)
+
+                    st.text_area("Conversation history:", log_content, height=300)
+
+            # Quick reply section
+            st.subheader(f"Reply to {selected_jid}")
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                reply_text = st.text_input("Your message:", key=f"reply_{selected_jid}")
+            with col2:
+                st.write("")  # Spacing
+                if st.button("Send", key=f"send_{selected_jid}", disabled=not st.session_state.connected):
+                    if reply_text:
+                        send_message(selected_jid, reply_text)
+                        st.success(f"Sent to {selected_jid}")
+                        st.rerun()
+    elif current_username and st.session_state.connected:
+        st.info("No conversation history yet. Send a message to start logging.")
+    else:
+        st.info("Connect to view message history.")
 
-# Only show logs for current logged-in user
-if current_username and os.path.exists(LOG_DIR):
-    jid_log_dir = os.path.join(LOG_DIR, current_username)
+    st.divider()
 
-    if os.path.exists(jid_log_dir):
-        # Get list of person folders under current username
-        person_folders = [d for d in os.listdir(jid_log_dir) if os.path.isdir(os.path.join(jid_log_dir, d))]
-    else:
-        person_folders = []
-else:
-    person_folders = []
+    # Display the most recent messages; older ones only on request
+    messages = st.session_state.messages
+    start = max(len(messages) - MAX_SHOWN_MESSAGES, 0)
+    if start and st.toggle(f"Show earlier {start} messages", key="show_earlier_messages"):
+        start = 0
+
+    # One element per run of consecutive messages of the same kind
+    for msg_type, group in groupby(islice(messages, start, None), key=lambda msg: msg.type):
+        if msg_type == 'system':
+            st.info("\n\n".join(f"**System:** {msg.body}" for msg in group))
+        elif msg_type == 'error':
+            st.error("\n\n".join(f"**Error:** {msg.body}" for msg in group))
+        else:
+            lines = "\n\n".join(f"**{msg.sender}:** {msg.body}" for msg in group)
+            if msg_type == 'sent':
+                st.success(lines)
+            else:
+                st.chat_message("user").write(lines)
 
-if person_folders:
-    # Convert folder names to JIDs for display
-    jid_display = {}
-    for folder in person_folders:
-        # Convert username_at_servername -> username@servername
-        jid = folder.replace('_at_', '@')
-        jid_display[jid] = folder
-
-    selected_jid = st.selectbox("Select conversation:", list(jid_display.keys()))
-
-    if selected_jid:
-        person_dir = os.path.join(jid_log_dir, jid_display[selected_jid])
-
-        # Get all date files for this person
-        date_files = sorted([f for f in os.listdir(person_dir) if f.endswith('.txt')], reverse=True)
-
-        if date_files:
-            # Create human-readable display names
-            from datetime import datetime, timedelta
-            date_display = {}
-            today = datetime.now().date()
-            yesterday = today - timedelta(days=1)
-
-            for filename in date_files:
-                # Parse filename: YYYY-MM-DD_NNN.txt
-                try:
-                    date_part = filename.split('_')[0]  # Get YYYY-MM-DD
-                    counter_part = filename.split('_')[1].replace('.txt', '')  # Get NNN
-                    file_date = datetime.strptime(date_part, '%Y-%m-%d').date()
-
-                    # Format display based on recency
-                    if file_date == today:
-                        display_name = f"📅 Today - Conversation #{int(counter_part)}"
-                    elif file_date == yesterday:
-                        display_name = f"📅 Yesterday - Conversation #{int(counter_part)}"
-                    else:
-                        formatted_date = file_date.strftime('%B %d, %Y')  # e.g., "October 07, 2025"
-                        display_name = f"📅 {formatted_date} - Conversation #{int(counter_part)}"
-
-                    date_display[display_name] = filename
-                except Exception:
-                    # Fallback if parsing fails
-                    date_display[filename.replace('.txt', '')] = filename
-
-            selected_date_display = st.selectbox("Select date:", list(date_display.keys()))
-            selected_date = date_display[selected_date_display]
-
-            if selected_date:
-                log_path = os.path.join(person_dir, selected_date)
-                with open(log_path, 'r', encoding='utf-8') as f:
-                    log_content = f.read()
-
-                st.text_area("Conversation history:", log_content, height=300)
-
-        # Quick reply section
-        st.subheader(f"Reply to {selected_jid}")
-        col1, col2 = st.columns([4, 1])
-        with col1:
-            reply_text = st.text_input("Your message:", key=f"reply_{selected_jid}")
-        with col2:
-            st.write("")  # Spacing
-            if st.button("Send", key=f"send_{selected_jid}", disabled=not st.session_state.connected):
-                if reply_text:
-                    send_message(selected_jid, reply_text)
-                    st.success(f"Sent to {selected_jid}")
-                    st.rerun()
-elif current_username and st.session_state.connected:
-    st.info("No conversation history yet. Send a message to start logging.")
-else:
-    st.info("Connect to view message history.")
-
-st.divider()
-
-# Display messages (skip presence updates)
-for msg in st.session_state.messages:
-    msg_type = msg.get('type', 'chat')
-    sender = msg.get('from', 'Unknown')
-    body = msg.get('body', '')
-
-    # Skip presence messages in UI
-    if msg_type == 'presence':
-        continue
-
-    if msg_type == 'system':
-        st.info(f"**System:** {body}")
-    elif msg_type == 'error':
-        st.error(f"**Error:** {body}")
-    elif msg_type == 'sent':
-        st.success(f"**{sender}:** {body}")
-    else:
-        st.chat_message("user").write(f"**{sender}:** {body}")
 
-# Auto-refresh
-if auto_refresh and st.session_state.connected:
-    time.sleep(refresh_interval)
-    st.rerun()
+# Auto-refresh only re-runs the chat page, not the sidebar
+run_every = refresh_interval if auto_refresh and st.session_state.connected else None
+st.fragment(run_every=run_every)(chat_page)()